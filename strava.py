@@ -1,50 +1,379 @@
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, aclosing
+import asyncio
+from collections import OrderedDict
 from collections.abc import AsyncIterator
 import os
+import json
+import tempfile
+import sqlite3
+import threading
 import time  
-import requests
+import httpx
+import ijson
+import orjson
 import logging
 from datetime import datetime
+from functools import lru_cache
+from operator import itemgetter
 from mcp.server.fastmcp import FastMCP
-from dotenv import load_dotenv
+from dotenv import load_dotenv, find_dotenv
 load_dotenv()
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 strava_client = None
 
+ETAG_CACHE_SIZE = 256
+ATHLETE_MAX_AGE = 300  # seconds
+# Activities can still be uploaded for the last few days, so never mark them as synced
+SYNC_GRACE_PERIOD = 2 * 86400  # seconds
+# Synced ranges are fetched again after this, picking up edits and deletions
+SYNC_MAX_AGE = 86400  # seconds
+PREFETCH_LIMIT = 4
+PREFETCH_MAX_AGE = 30  # seconds
+RATE_LIMIT_RETRIES = 3
+
+_get_type = itemgetter("type")
+
+def _parse(response):
+    return orjson.loads(response.content)
+
+@lru_cache(maxsize=1024)
+def _date_to_timestamp(date):
+    """Local midnight of a 'YYYY-MM-DD' date as a Unix timestamp."""
+    return int(datetime.fromisoformat(date).timestamp())
+
+def _timestamp(value):
+    return int(datetime.fromisoformat(value).timestamp()) if value else None
+
+class ActivityCache:
+    """
+    SQLite store of activity summaries, plus the time ranges that have been
+    fetched completely so those ranges can be answered without the API.
+    
+    Methods block, so StravaClient calls them through asyncio.to_thread;
+    the lock serializes them on the shared connection.
+    """
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS activities("
+                "id INTEGER PRIMARY KEY, start_date INTEGER, type TEXT, updated_at INTEGER, json BLOB)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS activities_start_date ON activities(start_date)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS synced_ranges(after INTEGER, before INTEGER, synced_at INTEGER)"
+            )
+            
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM activities")
+            self._conn.execute("DELETE FROM synced_ranges")
+            
+    def synced_until(self, after):
+        """
+        Return the end of the contiguous time range covering `after` that
+        was synced within SYNC_MAX_AGE, or `after` itself if it isn't covered.
+        """
+        fresh_since = int(time.time()) - SYNC_MAX_AGE
+        with self._lock:
+            while True:
+                (end,) = self._conn.execute(
+                    "SELECT MAX(before) FROM synced_ranges WHERE after <= ? AND before > ? AND synced_at >= ?",
+                    (after, after, fresh_since)
+                ).fetchone()
+                if end is None:
+                    return after
+                after = end
+            
+    def get(self, after, before, activity_type=None, limit=None):
+        query = "SELECT json FROM activities WHERE start_date >= ? AND start_date < ?"
+        params = [after, before]
+        if activity_type:
+            query += " AND type = ?"
+            params.append(activity_type)
+        query += " ORDER BY start_date"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [orjson.loads(row[0]) for row in rows]
+        
+    def store(self, activities, fetched_range=None, synced_range=None):
+        """
+        Save activities in one transaction. If `fetched_range` is given, the
+        activities are everything in that (after, before) range, so cached
+        activities there that are missing (deleted on Strava) are dropped.
+        If `synced_range` is given it is marked as fully synced.
+        """
+        now = int(time.time())
+        with self._lock, self._conn:
+            if fetched_range:
+                self._conn.execute(
+                    "DELETE FROM activities WHERE start_date >= ? AND start_date < ?",
+                    fetched_range
+                )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO activities(id, start_date, type, updated_at, json) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        a["id"],
+                        _timestamp(a.get("start_date")),
+                        a.get("type"),
+                        _timestamp(a.get("updated_at")),
+                        orjson.dumps(a)
+                    )
+                    for a in activities
+                ]
+            )
+            self._conn.execute("DELETE FROM synced_ranges WHERE synced_at < ?", (now - SYNC_MAX_AGE,))
+            if synced_range and synced_range[0] < synced_range[1]:
+                self._conn.execute(
+                    "INSERT INTO synced_ranges(after, before, synced_at) VALUES (?, ?, ?)",
+                    (*synced_range, now)
+                )
+
+class RateLimiter:
+    """
+    Token bucket sized to Strava's 15-minute request budget, with a cap on
+    concurrent requests and a shared "not before" time used to back off
+    when Strava reports the budget is nearly spent.
+    """
+    def __init__(self, max_requests=100, period=900, max_concurrency=8):
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._capacity = max_requests
+        self._rate = max_requests / period
+        self._tokens = float(max_requests)
+        self._updated = time.monotonic()
+        self._next_ok = 0.0
+        
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        try:
+            await self._wait()
+        except BaseException:
+            self._semaphore.release()
+            raise
+            
+    async def __aexit__(self, *exc_info):
+        self._semaphore.release()
+        
+    async def _wait(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            
+            delay = self._next_ok - now
+            if delay <= 0:
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self._rate
+            await asyncio.sleep(delay)
+            
+    def back_off(self, seconds):
+        self._next_ok = max(self._next_ok, time.monotonic() + seconds)
+        
+    def update(self, response):
+        """
+        Read Strava's X-RateLimit-Usage / X-RateLimit-Limit headers
+        ("15-minute,daily") and pause for a while once over 90% of the
+        15-minute budget is used.
+        """
+        usage = response.headers.get("X-RateLimit-Usage")
+        limit = response.headers.get("X-RateLimit-Limit")
+        if not usage or not limit:
+            return
+            
+        try:
+            used = int(usage.split(",")[0])
+            allowed = int(limit.split(",")[0])
+        except ValueError:
+            return
+            
+        if allowed and used / allowed > 0.9:
+            logger.warning(f"Strava rate limit nearly reached ({used}/{allowed}), slowing down")
+            self.back_off(15)
+
 class StravaClient:
-    def __init__(self, access_token, refresh_token, client_id, client_secret):
+    def __init__(self, access_token, refresh_token, client_id, client_secret, token_file=None, cache_path=None):
         self.access_token = access_token
         self.refresh_token = refresh_token
         self.client_id = client_id
         self.client_secret = client_secret
         self.token_expires_at = 0
-        self.base_url = "https://www.strava.com/api/v3"
+        self.token_file = token_file
+        # The token file only applies while .env still holds the refresh token it started from
+        self._env_refresh_token = refresh_token
+        self._load_tokens()
+        self.base_url = "https://www.strava.com"
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={
+                "Authorization": f"Bearer {self.access_token}",
+                "Accept-Encoding": "gzip, br"
+            },
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=60)
+        )
+        # path -> (etag, parsed body, time fetched), least recently used first
+        self._etag_cache = OrderedDict()
+        # key -> task for requests currently in flight
+        self._inflight = {}
+        # page key -> (task fetching a page we expect to be asked for next, time started)
+        self._prefetch = {}
+        self._refresh_lock = asyncio.Lock()
+        self._rate_limiter = RateLimiter()
+        # Activity types seen so far, None until first fetched
+        self._types = None
+        self._cache = ActivityCache(cache_path) if cache_path else None
+        
+    async def aclose(self):
+        self._prefetch.clear()
+        await self._client.aclose()
+        if self._cache:
+            await asyncio.to_thread(self._cache.close)
         
-    def refresh_access_token_if_needed(self):
-        current_time = time.time()
-        if current_time >= (self.token_expires_at - 300):
-            refresh_url = "https://www.strava.com/oauth/token"
+    async def _dedupe(self, key, coro_factory):
+        """
+        Run `coro_factory()` unless an identical request is already in
+        flight, in which case wait for that request's result instead.
+        """
+        # Shield so one cancelled caller doesn't cancel the request for the others
+        return await asyncio.shield(self._start(key, coro_factory))
+        
+    def _start(self, key, coro_factory):
+        """
+        Return the in-flight task for `key`, starting `coro_factory()` as a
+        new task if there is none.
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = task
+            
+            def forget(done):
+                if self._inflight.get(key) is done:
+                    del self._inflight[key]
+                    
+            task.add_done_callback(forget)
+        return task
+        
+    async def refresh_access_token_if_needed(self):
+        # Only refresh up front when the token is known to have expired;
+        # otherwise _request refreshes lazily when Strava answers 401.
+        if self.token_expires_at and time.time() >= self.token_expires_at:
+            await self._refresh_access_token(self.access_token)
+            
+    async def _refresh_access_token(self, stale_token):
+        async with self._refresh_lock:
+            # Another coroutine may have refreshed while we waited for the lock
+            if self.access_token != stale_token and time.time() < self.token_expires_at - 60:
+                return
+                
             payload = {
                 "client_id": self.client_id,
                 "client_secret": self.client_secret,
                 "refresh_token": self.refresh_token,
                 "grant_type": "refresh_token"
             }
-            response = requests.post(refresh_url, data=payload)
+            response = await self._client.post("/oauth/token", data=payload)
             if response.status_code == 200:
-                data = response.json()
+                data = _parse(response)
                 self.access_token = data["access_token"]
                 self.refresh_token = data["refresh_token"]
                 self.token_expires_at = data["expires_at"]
-                self._save_tokens()
+                # Sent with every request, so only rebuilt when the token changes
+                self._client.headers["Authorization"] = f"Bearer {self.access_token}"
+                await asyncio.to_thread(self._save_tokens)
             else:
                 raise Exception(f"Failed to refresh token: {response.text}")
                 
+    async def _request(self, method, path, headers=None, stream=False, **kwargs):
+        """
+        Send an authenticated, rate-limited request, refreshing the access
+        token and retrying once if Strava rejects it with a 401, and backing
+        off and retrying if it answers 429.
+        
+        With stream=True the body is not read; the caller must close the
+        response.
+        """
+        await self.refresh_access_token_if_needed()
+        
+        async def send():
+            for attempt in range(RATE_LIMIT_RETRIES + 1):
+                request = self._client.build_request(method, path, headers=headers, **kwargs)
+                async with self._rate_limiter:
+                    response = await self._client.send(request, stream=stream)
+                self._rate_limiter.update(response)
+                
+                if response.status_code != 429 or attempt == RATE_LIMIT_RETRIES:
+                    return response
+                    
+                try:
+                    delay = float(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    delay = 5 * 2 ** attempt
+                logger.warning(f"Rate limited by Strava on {path}, retrying in {delay}s")
+                await response.aclose()
+                self._rate_limiter.back_off(delay)
+            
+        token = self.access_token
+        response = await send()
+        if response.status_code == 401:
+            logger.info("Access token rejected, refreshing")
+            await response.aclose()
+            await self._refresh_access_token(token)
+            response = await send()
+            
+        logger.debug(f"{method} {path}: content-encoding={response.headers.get('content-encoding')}")
+        return response
+        
+    def _load_tokens(self):
+        if not self.token_file or not os.path.exists(self.token_file):
+            return
+            
+        try:
+            with open(self.token_file) as f:
+                data = json.load(f)
+            if data.get("env_refresh_token") != self._env_refresh_token:
+                logger.info(f"Ignoring {self.token_file}: tokens in .env have changed")
+                return
+            self.access_token = data["access_token"]
+            self.refresh_token = data["refresh_token"]
+            self.token_expires_at = data["expires_at"]
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable token file {self.token_file}: {e}")
+            
     def _save_tokens(self):
         logger.info(f"New access token obtained, expires at: {self.token_expires_at}")
+        if not self.token_file:
+            return
+            
+        data = {
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "expires_at": self.token_expires_at,
+            "env_refresh_token": self._env_refresh_token
+        }
+        # Write to a temporary file and rename it so a crash never leaves a partial file
+        directory = os.path.dirname(os.path.abspath(self.token_file))
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=directory, delete=False) as f:
+                json.dump(data, f)
+            os.replace(f.name, self.token_file)
+        except OSError as e:
+            logger.error(f"Failed to save tokens to {self.token_file}: {e}")
         
-    def get_activities(self, limit=100, before=None, after=None, activity_type=None, page=1):  
+    async def get_activities(self, limit=100, before=None, after=None, activity_type=None, page=1):  
         """
         Get activities with filtering options.
         
@@ -58,9 +387,53 @@ class StravaClient:
         Returns:
             List of activities matching the criteria
         """
-        self.refresh_access_token_if_needed() 
-        headers = {"Authorization": f"Bearer {self.access_token}"}
+        activities = None
+        prefetched = self._prefetch.pop((limit, before, after, page, activity_type), None)
+        if prefetched and time.monotonic() - prefetched[1] < PREFETCH_MAX_AGE:
+            try:
+                activities, count = await asyncio.shield(prefetched[0])
+            except Exception:
+                logger.debug(f"Prefetch of activities page {page} failed, fetching again")
+        if activities is None:
+            activities, count = await self._get_activities_page(limit, before, after, page, activity_type)
+            
+        # A full default-sized page usually means the caller will ask for the next one
+        if limit == 100 and count == limit:
+            self._prefetch_page(limit, before, after, page + 1, activity_type)
+            
+        return activities
+    
+    def _prefetch_page(self, limit, before, after, page, activity_type):
+        key = (limit, before, after, page, activity_type)
+        # Replace any older prefetch so the page reflects the page just fetched
+        self._prefetch.pop(key, None)
+        
+        task = self._start_activities_page(limit, before, after, page, activity_type)
+        # Unused prefetches may fail unobserved; retrieve the error so it isn't logged
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._prefetch[key] = (task, time.monotonic())
+        
+        if len(self._prefetch) > PREFETCH_LIMIT:
+            oldest = next(iter(self._prefetch))
+            # Not cancelled: the task is shared with any caller awaiting the same page
+            del self._prefetch[oldest]
+            
+    async def _get_activities_page(self, limit, before, after, page, activity_type=None):
+        """
+        Fetch one page of activities.
         
+        Returns:
+            Tuple of (activities matching activity_type, number of activities on the page)
+        """
+        return await asyncio.shield(self._start_activities_page(limit, before, after, page, activity_type))
+        
+    def _start_activities_page(self, limit, before, after, page, activity_type):
+        return self._start(
+            f"activities:{before}:{after}:{page}:{limit}:{activity_type}",
+            lambda: self._fetch_activities(limit, before, after, page, activity_type)
+        )
+    
+    async def _fetch_activities(self, limit, before, after, page, activity_type):
         params = {
             "per_page": limit,
             "page": page
@@ -71,24 +444,47 @@ class StravaClient:
         if after:
             params["after"] = after
             
-        response = requests.get(
-            f"{self.base_url}/athlete/activities",
-            headers=headers,
-            params=params
+        response = await self._request(
+            "GET",
+            "/api/v3/athlete/activities",
+            params=params,
+            stream=True
         )
         
-        if response.status_code != 200:
-            logger.error(f"Error fetching activities: {response.text}")
-            raise Exception(f"Failed to fetch activities: {response.text}")
+        try:
+            if response.status_code != 200:
+                await response.aread()
+                logger.error(f"Error fetching activities: {response.text}")
+                raise Exception(f"Failed to fetch activities: {response.text}")
+                
+            # Parse the page as it arrives and keep only the matching activities,
+            # instead of building every activity dict and filtering afterwards
+            activities = []
+            count = 0
+            parsed = ijson.sendable_list()
+            parser = ijson.items_coro(parsed, "item", use_float=True)
             
-        activities = response.json()
-        
-        if activity_type:
-            activities = [a for a in activities if a.get("type") == activity_type]
+            def collect():
+                nonlocal count
+                count += len(parsed)
+                self._learn_activity_types(parsed)
+                if activity_type:
+                    activities.extend(a for a in parsed if "type" in a and _get_type(a) == activity_type)
+                else:
+                    activities.extend(parsed)
+                del parsed[:]
+                
+            async for chunk in response.aiter_bytes():
+                parser.send(chunk)
+                collect()
+            parser.close()
+            collect()
+        finally:
+            await response.aclose()
             
-        return activities
+        return activities, count
     
-    def get_activities_by_date_range(self, start_date, end_date, limit=100, activity_type=None):
+    async def get_activities_by_date_range(self, start_date, end_date, limit=100, activity_type=None):
         """
         Get activities within a specific date range using human-readable dates.
         
@@ -101,12 +497,16 @@ class StravaClient:
         Returns:
             List of activities within the date range
         """
-        after = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp())
-        before = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp()) + 86400  # Add a day to include the end date
+        after = _date_to_timestamp(start_date)
+        before = _date_to_timestamp(end_date) + 86400  # Add a day to include the end date
         
-        return self.get_activities(limit=limit, before=before, after=after, activity_type=activity_type)
+        if self._cache:
+            await self._sync_range(after, before, self._fetch_range)
+            return await asyncio.to_thread(self._cache.get, after, before, activity_type, limit)
+            
+        return await self.get_activities(limit=limit, before=before, after=after, activity_type=activity_type)
     
-    def get_all_activities_by_date_range(self, start_date, end_date, activity_type=None, max_pages=10):
+    async def get_all_activities_by_date_range(self, start_date, end_date, activity_type=None, max_pages=10):
         """
         Get all activities within a date range, handling pagination automatically.
         
@@ -119,44 +519,259 @@ class StravaClient:
         Returns:
             List of all activities in the date range
         """
-        after = int(datetime.strptime(start_date, "%Y-%m-%d").timestamp())
-        before = int(datetime.strptime(end_date, "%Y-%m-%d").timestamp()) + 86400
+        after = _date_to_timestamp(start_date)
+        before = _date_to_timestamp(end_date) + 86400
         
-        all_activities = []
-        page = 1
+        if self._cache:
+            await self._sync_range(
+                after,
+                before,
+                lambda after, before: self._fetch_range(after, before, max_pages=max_pages)
+            )
+            return await asyncio.to_thread(self._cache.get, after, before, activity_type)
+            
+        return await self._get_all_pages(
+            before=before,
+            after=after,
+            activity_type=activity_type,
+            max_pages=max_pages
+        )
+    
+    async def iter_activities(self, start_date, end_date, activity_type=None, max_pages=10):
+        """
+        Iterate over activities within a date range, one page at a time.
+        
+        While the caller consumes page N, page N+1 is already being fetched,
+        so callers that stop early never pay for the remaining pages.
         
-        while page <= max_pages:
-            activities = self.get_activities(limit=100, before=before, after=after, page=page)
+        Args:
+            start_date: Start date string in format 'YYYY-MM-DD'
+            end_date: End date string in format 'YYYY-MM-DD'
+            activity_type: Filter by activity type (optional)
+            max_pages: Maximum number of pages to fetch to prevent infinite loops
             
-            if not activities:
-                break
+        Yields:
+            Activities in the date range
+        """
+        after = _date_to_timestamp(start_date)
+        before = _date_to_timestamp(end_date) + 86400
+        
+        # Answer from the cache when it holds the whole range, so this agrees
+        # with the other date-range methods
+        if self._cache and await asyncio.to_thread(self._cache.synced_until, after) >= before:
+            for activity in await asyncio.to_thread(self._cache.get, after, before, activity_type):
+                yield activity
+            return
+            
+        page = 1
+        next_task = asyncio.create_task(self._get_activities_page(100, before, after, page, activity_type))
+        try:
+            while next_task:
+                activities, count = await next_task
+                next_task = None
+                if count == 100 and page < max_pages:
+                    page += 1
+                    next_task = asyncio.create_task(
+                        self._get_activities_page(100, before, after, page, activity_type)
+                    )
+                    
+                for activity in activities:
+                    yield activity
+        finally:
+            if next_task:
+                next_task.cancel()
                 
-            if activity_type:
-                activities = [a for a in activities if a.get("type") == activity_type]
+    async def get_all_activities_in_year(self, year, activity_type=None):
+        """
+        Get all activities for a year, fetching each month concurrently.
+        
+        Args:
+            year: The year to get activities for
+            activity_type: Filter by activity type (optional)
+            
+        Returns:
+            List of all activities in the year, in month order
+        """
+        after = int(datetime(year, 1, 1).timestamp())
+        before = int(datetime(year + 1, 1, 1).timestamp())
+        
+        if self._cache:
+            await self._sync_range(after, before, self._fetch_by_month)
+            return await asyncio.to_thread(self._cache.get, after, before, activity_type)
+            
+        activities, _ = await self._fetch_by_month(after, before, activity_type)
+        return activities
+        
+    async def _fetch_by_month(self, after, before, activity_type=None):
+        """
+        Fetch all activities between two timestamps as concurrent
+        calendar-month windows.
+        
+        Returns:
+            Tuple of (activities, whether no month hit the page limit)
+        """
+        windows = []
+        start = datetime.fromtimestamp(after)
+        year, month = start.year, start.month
+        month_start = int(datetime(year, month, 1).timestamp())
+        while month_start < before:
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            # End each window where the next one starts so DST changes can't
+            # leave gaps or overlaps between months
+            month_end = int(datetime(year, month, 1).timestamp())
+            windows.append((max(after, month_start), min(before, month_end)))
+            month_start = month_end
+            
+        # Shared across months to stay well inside Strava's rate limits
+        semaphore = asyncio.Semaphore(6)
+        months = await asyncio.gather(*[
+            self._get_all_pages(
+                before=before,
+                after=after,
+                activity_type=activity_type,
+                per_page=200,
+                semaphore=semaphore
+            )
+            for after, before in windows
+        ])
+        
+        complete = all(len(activities) < 200 * 10 for activities in months)
+        return [activity for activities in months for activity in activities], complete
+        
+    async def _fetch_range(self, after, before, max_pages=10):
+        activities = await self._get_all_pages(before=before, after=after, max_pages=max_pages)
+        return activities, len(activities) < 100 * max_pages
+        
+    async def _sync_range(self, after, before, fetch):
+        """
+        Make sure the cache holds every activity between two timestamps,
+        fetching only the part after what has already been synced.
+        
+        Args:
+            after: Start of the range as a Unix timestamp
+            before: End of the range as a Unix timestamp
+            fetch: Coroutine function taking (after, before) and returning
+                (activities, whether the range was fetched completely)
+        """
+        synced = await asyncio.to_thread(self._cache.synced_until, after)
+        if synced >= before:
+            return
+            
+        activities, complete = await fetch(synced, before)
+        if complete:
+            synced_to = min(before, int(time.time()) - SYNC_GRACE_PERIOD)
+            await asyncio.to_thread(self._cache.store, activities, (synced, before), (synced, synced_to))
+        else:
+            await asyncio.to_thread(self._cache.store, activities)
+            
+    async def clear_cache(self):
+        """Forget all cached activity summaries and synced ranges."""
+        if self._cache:
+            await asyncio.to_thread(self._cache.clear)
+        
+    async def _get_all_pages(self, before, after, activity_type=None, per_page=100, max_pages=10, semaphore=None):
+        """
+        Fetch every page of activities between two timestamps.
+        
+        Page 1 is fetched first; if it is full, the remaining pages are
+        requested concurrently, bounded by `semaphore` (4 at a time by
+        default). Pages past the first short page are skipped or discarded.
+        """
+        semaphore = semaphore or asyncio.Semaphore(4)
+        async with semaphore:
+            first_page, count = await self._get_activities_page(per_page, before, after, 1, activity_type)
+        if count < per_page or max_pages <= 1:
+            return first_page
+            
+        last_page = max_pages
+        
+        async def fetch(page):
+            nonlocal last_page
+            async with semaphore:
+                if page > last_page:
+                    return [], 0
+                activities, count = await self._get_activities_page(per_page, before, after, page, activity_type)
+                if count < per_page:
+                    last_page = min(last_page, page)
+                return activities, count
                 
+        pages = await asyncio.gather(*[fetch(p) for p in range(2, max_pages + 1)])
+        
+        all_activities = list(first_page)
+        for activities, count in pages:
             all_activities.extend(activities)
-            page += 1
-            
-            if len(activities) < 100:
+            if count < per_page:
                 break
                 
         return all_activities
         
-    def get_activity_types(self):
+    async def get_activity_types(self):
         """
         Get a list of all unique activity types from recent activities.
         Useful for providing options to users.
         """
-        activities = self.get_activities(limit=200)  # Get a good sample
-        return list(set(a.get("type") for a in activities if a.get("type")))
+        if self._types is None:
+            activities = await self.get_activities(limit=200)  # Get a good sample
+            self._types = frozenset(_get_type(a) for a in activities if a.get("type"))
+        return sorted(self._types)
+        
+    def _learn_activity_types(self, activities):
+        # Pick up types that show up in any later response so the set stays current.
+        # The set is replaced rather than mutated so readers always see a consistent one.
+        if self._types is not None:
+            new_types = {_get_type(a) for a in activities if a.get("type")} - self._types
+            if new_types:
+                self._types = self._types | new_types
+        
+    async def _get_with_etag(self, path, error_message, max_age=None):
+        """
+        GET a rarely-changing resource, revalidating a cached copy with
+        If-None-Match so an unchanged resource costs an empty 304 response.
+        
+        Args:
+            path: API path to fetch
+            error_message: Prefix for the exception raised on failure
+            max_age: Seconds a cached copy is served without revalidating
+            
+        Returns:
+            Parsed response body
+        """
+        cached = self._etag_cache.get(path)
+        if cached:
+            self._etag_cache.move_to_end(path)
+            etag, body, fetched_at = cached
+            if max_age and time.monotonic() - fetched_at < max_age:
+                return body
+                
+        headers = {"If-None-Match": cached[0]} if cached and cached[0] else None
+        response = await self._request("GET", path, headers=headers)
+        
+        if response.status_code == 304 and cached:
+            self._etag_cache[path] = (etag, body, time.monotonic())
+            return body
+            
+        if response.status_code != 200:
+            logger.error(f"Error fetching {path}: {response.text}")
+            raise Exception(f"{error_message}: {response.text}")
+            
+        body = _parse(response)
+        etag = response.headers.get("ETag")
+        if etag or max_age:
+            self._etag_cache[path] = (etag, body, time.monotonic())
+            self._etag_cache.move_to_end(path)
+            if len(self._etag_cache) > ETAG_CACHE_SIZE:
+                self._etag_cache.popitem(last=False)
+                
+        return body
         
-    def get_athlete(self): 
-        self.refresh_access_token_if_needed()
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        response = requests.get(f"{self.base_url}/athlete", headers=headers)
-        return response.json()
+    async def get_athlete(self): 
+        return await self._dedupe("athlete", lambda: self._get_with_etag(
+            "/api/v3/athlete",
+            "Failed to fetch athlete",
+            max_age=ATHLETE_MAX_AGE
+        ))
     
-    def get_activity_by_id(self, activity_id):
+    async def get_activity_by_id(self, activity_id):
         """
         Get detailed information about a specific activity.
         
@@ -166,15 +781,10 @@ class StravaClient:
         Returns:
             Activity details
         """
-        self.refresh_access_token_if_needed()
-        headers = {"Authorization": f"Bearer {self.access_token}"}
-        response = requests.get(f"{self.base_url}/activities/{activity_id}", headers=headers)
-        
-        if response.status_code != 200:
-            logger.error(f"Error fetching activity {activity_id}: {response.text}")
-            raise Exception(f"Failed to fetch activity: {response.text}")
-            
-        return response.json()
+        return await self._dedupe(f"activity:{activity_id}", lambda: self._get_with_etag(
+            f"/api/v3/activities/{activity_id}",
+            "Failed to fetch activity"
+        ))
 
 @asynccontextmanager
 async def app_lifespan(server: FastMCP) -> AsyncIterator[None]:
@@ -184,37 +794,57 @@ async def app_lifespan(server: FastMCP) -> AsyncIterator[None]:
     refresh_token = os.getenv("STRAVA_REFRESH_TOKEN") 
     client_id = os.getenv("STRAVA_CLIENT_ID")
     client_secret = os.getenv("STRAVA_CLIENT_SECRET")
+    token_file = os.getenv(
+        "STRAVA_TOKEN_FILE",
+        os.path.join(os.path.dirname(find_dotenv()), ".strava_tokens.json")
+    )
+    cache_path = os.getenv(
+        "STRAVA_CACHE_DB",
+        os.path.join(os.path.dirname(find_dotenv()), "strava_cache.db")
+    )
     
     strava_client = StravaClient(
         access_token=access_token,
         refresh_token=refresh_token,
         client_id=client_id,
-        client_secret=client_secret
+        client_secret=client_secret,
+        token_file=token_file,
+        cache_path=cache_path
     )
     
+    async def warm_activity_types(client):
+        try:
+            await client.get_activity_types()
+        except Exception as e:
+            logger.warning(f"Could not prefetch activity types: {e}")
+            
+    warm_task = asyncio.create_task(warm_activity_types(strava_client))
+    
     try:
         yield
     finally:
+        warm_task.cancel()
+        await strava_client.aclose()
         strava_client = None
 
 mcp = FastMCP("Strava Assistant", lifespan=app_lifespan)
 
 @mcp.tool()
-def test_connection() -> dict:
+async def test_connection() -> dict:
     return {"status": "connected", "timestamp": time.time()}
 
 @mcp.tool()
-def get_recent_activities(limit: int) -> list:
+async def get_recent_activities(limit: int, page: int = 1) -> list:
     global strava_client
     
     if not strava_client:
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    activities = strava_client.get_activities(limit=limit)
+    activities = await strava_client.get_activities(limit=limit, page=page)
     return activities
 
 @mcp.tool()
-def get_activities_by_date_range(start_date: str, end_date: str, activity_type: str = None) -> list:
+async def get_activities_by_date_range(start_date: str, end_date: str, activity_type: str = None) -> list:
     """
     Get activities within a specific date range.
     
@@ -231,14 +861,50 @@ def get_activities_by_date_range(start_date: str, end_date: str, activity_type:
     if not strava_client:
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    return strava_client.get_activities_by_date_range(
+    return await strava_client.get_activities_by_date_range(
         start_date=start_date,
         end_date=end_date,
         activity_type=activity_type
     )
 
 @mcp.tool()
-def get_all_activities_in_year(year: int, activity_type: str = None) -> list:
+async def get_first_activities_by_date_range(start_date: str, end_date: str, limit: int, activity_type: str = None) -> list:
+    """
+    Get up to `limit` activities within a specific date range, stopping as
+    soon as enough activities have been found.
+    
+    Args:
+        start_date: Start date in format 'YYYY-MM-DD'
+        end_date: End date in format 'YYYY-MM-DD'
+        limit: Maximum number of activities to return
+        activity_type: Optional filter for activity type (Run, Ride, etc.)
+        
+    Returns:
+        List of at most `limit` activities within the date range
+    """
+    global strava_client
+    
+    if not strava_client:
+        raise ValueError("Strava client not initialized. Check server logs.")
+    
+    activities = []
+    if limit <= 0:
+        return activities
+        
+    async with aclosing(strava_client.iter_activities(
+        start_date=start_date,
+        end_date=end_date,
+        activity_type=activity_type
+    )) as activity_iter:
+        async for activity in activity_iter:
+            activities.append(activity)
+            if len(activities) >= limit:
+                break
+            
+    return activities
+
+@mcp.tool()
+async def get_all_activities_in_year(year: int, activity_type: str = None) -> list:
     """
     Get all activities for a specific year.
     
@@ -254,17 +920,30 @@ def get_all_activities_in_year(year: int, activity_type: str = None) -> list:
     if not strava_client:
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    start_date = f"{year}-01-01"
-    end_date = f"{year}-12-31"
-    
-    return strava_client.get_all_activities_by_date_range(
-        start_date=start_date,
-        end_date=end_date,
+    return await strava_client.get_all_activities_in_year(
+        year=year,
         activity_type=activity_type
     )
 
 @mcp.tool()
-def get_available_activity_types() -> list:
+async def clear_activity_cache() -> dict:
+    """
+    Clear the local cache of activity summaries so the next queries fetch
+    fresh data from Strava.
+    
+    Returns:
+        Confirmation that the cache was cleared
+    """
+    global strava_client
+    
+    if not strava_client:
+        raise ValueError("Strava client not initialized. Check server logs.")
+    
+    await strava_client.clear_cache()
+    return {"status": "cleared"}
+
+@mcp.tool()
+async def get_available_activity_types() -> list:
     """
     Get a list of all available activity types.
     
@@ -276,21 +955,21 @@ def get_available_activity_types() -> list:
     if not strava_client:
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    return strava_client.get_activity_types()
+    return await strava_client.get_activity_types()
 
 @mcp.tool()
-def get_athlete_profile() -> dict:
+async def get_athlete_profile() -> dict:
     global strava_client
     
     if not strava_client:
         logger.error("Strava client not initialized")
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    profile = strava_client.get_athlete()
+    profile = await strava_client.get_athlete()
     return profile
 
 @mcp.tool()
-def get_activity_details(activity_id: str) -> dict:
+async def get_activity_details(activity_id: str) -> dict:
     """
     Get detailed information about a specific activity.
     
@@ -305,7 +984,7 @@ def get_activity_details(activity_id: str) -> dict:
     if not strava_client:
         raise ValueError("Strava client not initialized. Check server logs.")
     
-    return strava_client.get_activity_by_id(activity_id)
+    return await strava_client.get_activity_by_id(activity_id)
     
 if __name__ == "__main__":
     mcp.run()
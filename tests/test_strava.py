@@ -0,0 +1,525 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+import httpx
+import pytest
+
+import strava
+
+
+class FakeStrava:
+    """
+    Minimal stand-in for the activities API: `after` is inclusive, `before`
+    exclusive, results are sorted by start time and paginated.
+    """
+    def __init__(self, activities=()):
+        self.activities = list(activities)
+        self.requests = []
+
+    def add(self, activity_id, start, activity_type="Run"):
+        activity = {
+            "id": activity_id,
+            "type": activity_type,
+            "start_date": datetime.fromtimestamp(start).astimezone().isoformat()
+        }
+        self.activities.append(activity)
+        return activity
+
+    def handler(self, request):
+        self.requests.append(dict(request.url.params))
+        params = request.url.params
+        after = int(params.get("after", 0))
+        before = int(params.get("before", 2**40))
+        matching = sorted(
+            (a for a in self.activities if after <= strava._timestamp(a["start_date"]) < before),
+            key=lambda a: a["start_date"]
+        )
+        page, per_page = int(params["page"]), int(params["per_page"])
+        return httpx.Response(200, json=matching[(page - 1) * per_page:page * per_page])
+
+
+class EndlessStrava(FakeStrava):
+    """Returns a full page for every request, as if the range never ends."""
+    def handler(self, request):
+        self.requests.append(dict(request.url.params))
+        per_page = int(request.url.params["per_page"])
+        page = int(request.url.params["page"])
+        start = datetime(2024, 1, 1).timestamp()
+        return httpx.Response(200, json=[
+            {"id": page * per_page + i, "type": "Run", "start_date": datetime.fromtimestamp(start).astimezone().isoformat()}
+            for i in range(per_page)
+        ])
+
+
+class FakeDetails:
+    """Serves activity details and the athlete, answering If-None-Match with 304."""
+    def __init__(self):
+        self.requests = []
+
+    def handler(self, request):
+        self.requests.append(request)
+        etag = f'"{request.url.path}"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, json={"path": request.url.path}, headers={"ETag": etag})
+
+
+class SlowDetails(FakeDetails):
+    async def handler(self, request):
+        await asyncio.sleep(0.01)
+        return FakeDetails.handler(self, request)
+
+
+class FakeAuth(SlowDetails):
+    """Rejects every token but the one handed out by /oauth/token."""
+    def __init__(self):
+        super().__init__()
+        self.refreshes = 0
+
+    async def handler(self, request):
+        if request.url.path == "/oauth/token":
+            self.refreshes += 1
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={
+                "access_token": "new-token",
+                "refresh_token": "new-refresh",
+                "expires_at": int(time.time()) + 3600
+            })
+        if request.headers["Authorization"] != "Bearer new-token":
+            self.requests.append(request)
+            return httpx.Response(401)
+        return await SlowDetails.handler(self, request)
+
+
+async def make_client(api, cache_path=None, token_file=None):
+    client = strava.StravaClient("token", "refresh", "id", "secret", token_file=token_file, cache_path=cache_path)
+    await client._client.aclose()
+    client._client = httpx.AsyncClient(
+        base_url="https://www.strava.com",
+        transport=httpx.MockTransport(api.handler),
+        headers=client._client.headers
+    )
+    client._rate_limiter = strava.RateLimiter(max_requests=10_000)
+    return client
+
+
+def run(coro_factory):
+    return asyncio.run(coro_factory())
+
+
+def ts(*args):
+    return int(datetime(*args).timestamp())
+
+
+@pytest.fixture
+def berlin_tz():
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = "Europe/Berlin"
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = previous
+    time.tzset()
+
+
+def test_get_all_pages_stops_at_first_short_page():
+    api = FakeStrava()
+    for i in range(250):
+        api.add(i, ts(2024, 1, 1) + i * 3600, "Run" if i % 2 else "Ride")
+
+    async def main():
+        client = await make_client(api)
+        activities = await client._get_all_pages(before=ts(2025, 1, 1), after=ts(2024, 1, 1))
+        runs = await client._get_all_pages(before=ts(2025, 1, 1), after=ts(2024, 1, 1), activity_type="Run")
+        await client.aclose()
+        return activities, runs
+
+    activities, runs = run(main)
+    assert [a["id"] for a in activities] == list(range(250))
+    # Filtered pages are short, but pagination must still use the raw page size
+    assert [a["id"] for a in runs] == list(range(1, 250, 2))
+
+
+def test_activity_details_are_revalidated_with_etag():
+    api = FakeDetails()
+
+    async def main():
+        client = await make_client(api)
+        first = await client.get_activity_by_id(1)
+        second = await client.get_activity_by_id(1)
+        await client.aclose()
+        return first, second
+
+    first, second = run(main)
+    assert first == second == {"path": "/api/v3/activities/1"}
+    assert "If-None-Match" not in api.requests[0].headers
+    assert api.requests[1].headers["If-None-Match"] == '"/api/v3/activities/1"'
+
+
+def test_athlete_is_served_without_request_within_max_age():
+    api = FakeDetails()
+
+    async def main():
+        client = await make_client(api)
+        first = await client.get_athlete()
+        second = await client.get_athlete()
+        await client.aclose()
+        return first, second
+
+    first, second = run(main)
+    assert first == second
+    assert len(api.requests) == 1
+
+
+def test_etag_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(strava, "ETAG_CACHE_SIZE", 2)
+    api = FakeDetails()
+
+    async def main():
+        client = await make_client(api)
+        for activity_id in (1, 2, 1, 3):
+            await client.get_activity_by_id(activity_id)
+        cached = list(client._etag_cache)
+        await client.aclose()
+        return cached
+
+    assert run(main) == ["/api/v3/activities/1", "/api/v3/activities/3"]
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    api = SlowDetails()
+
+    async def main():
+        client = await make_client(api)
+        results = await asyncio.gather(client.get_activity_by_id(1), client.get_activity_by_id(1))
+        await client.aclose()
+        return results
+
+    first, second = run(main)
+    assert first == second == {"path": "/api/v3/activities/1"}
+    assert len(api.requests) == 1
+
+
+def test_cancelled_caller_does_not_cancel_coalesced_request():
+    api = SlowDetails()
+
+    async def main():
+        client = await make_client(api)
+        cancelled = asyncio.create_task(client.get_activity_by_id(1))
+        waiter = asyncio.create_task(client.get_activity_by_id(1))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        result = await waiter
+        await client.aclose()
+        return cancelled, result
+
+    cancelled, result = run(main)
+    assert cancelled.cancelled()
+    assert result == {"path": "/api/v3/activities/1"}
+    assert len(api.requests) == 1
+
+
+def test_concurrent_401s_refresh_the_token_once(tmp_path):
+    api = FakeAuth()
+    token_file = tmp_path / "tokens.json"
+
+    async def main():
+        client = await make_client(api, token_file=token_file)
+        results = await asyncio.gather(*(client.get_activity_by_id(i) for i in range(3)))
+        await client.aclose()
+        return results
+
+    results = run(main)
+    assert results == [{"path": f"/api/v3/activities/{i}"} for i in range(3)]
+    assert api.refreshes == 1
+    saved = json.loads(token_file.read_text())
+    assert saved["access_token"] == "new-token"
+    assert saved["refresh_token"] == "new-refresh"
+    assert saved["env_refresh_token"] == "refresh"
+    # Written through a temporary file that is renamed into place
+    assert [p.name for p in tmp_path.iterdir()] == ["tokens.json"]
+
+
+def test_token_file_is_ignored_when_env_tokens_change(tmp_path):
+    token_file = tmp_path / "tokens.json"
+    token_file.write_text(json.dumps({
+        "access_token": "saved-token",
+        "refresh_token": "saved-refresh",
+        "expires_at": int(time.time()) + 3600,
+        "env_refresh_token": "refresh"
+    }))
+
+    async def main():
+        clients = [
+            strava.StravaClient("token", env_refresh, "id", "secret", token_file=token_file)
+            for env_refresh in ("refresh", "changed-refresh")
+        ]
+        for client in clients:
+            await client.aclose()
+        return clients
+
+    unchanged, changed = run(main)
+    assert (unchanged.access_token, unchanged.refresh_token) == ("saved-token", "saved-refresh")
+    assert (changed.access_token, changed.refresh_token) == ("token", "changed-refresh")
+
+
+def test_fetch_by_month_reports_incomplete_at_page_limit():
+    async def main():
+        client = await make_client(EndlessStrava())
+        result = await client._fetch_by_month(ts(2024, 1, 1), ts(2024, 2, 1))
+        await client.aclose()
+        return result
+
+    activities, complete = run(main)
+    assert len(activities) == 200 * 10
+    assert not complete
+
+
+def test_fetch_by_month_windows_are_contiguous_across_dst(berlin_tz):
+    async def main():
+        api = FakeStrava()
+        client = await make_client(api)
+        await client._fetch_by_month(ts(2021, 1, 1), ts(2025, 1, 1))
+        await client.aclose()
+        return sorted((int(r["after"]), int(r["before"])) for r in api.requests)
+
+    windows = run(main)
+    assert len(windows) == 48
+    assert windows[0][0] == ts(2021, 1, 1)
+    assert windows[-1][1] == ts(2025, 1, 1)
+    assert all(windows[i][1] == windows[i + 1][0] for i in range(len(windows) - 1))
+
+
+def test_synced_until_follows_contiguous_ranges(tmp_path):
+    cache = strava.ActivityCache(tmp_path / "cache.db")
+    cache.store([], synced_range=(100, 200))
+    cache.store([], synced_range=(200, 300))
+    cache.store([], synced_range=(150, 250))
+    cache.store([], synced_range=(400, 500))
+
+    assert cache.synced_until(100) == 300
+    assert cache.synced_until(250) == 300
+    assert cache.synced_until(300) == 300
+    assert cache.synced_until(50) == 50
+    assert cache.synced_until(450) == 500
+    cache.close()
+
+
+def test_synced_until_ignores_expired_ranges(tmp_path):
+    cache = strava.ActivityCache(tmp_path / "cache.db")
+    cache.store([], synced_range=(100, 200))
+    with cache._conn:
+        cache._conn.execute("UPDATE synced_ranges SET synced_at = ?", (int(time.time()) - strava.SYNC_MAX_AGE - 1,))
+
+    assert cache.synced_until(100) == 100
+    cache.close()
+
+
+def test_store_with_fetched_range_drops_deleted_activities(tmp_path):
+    api = FakeStrava()
+    kept = api.add(1, ts(2024, 3, 1, 10))
+    deleted = api.add(2, ts(2024, 3, 2, 10))
+    outside = api.add(3, ts(2024, 5, 1, 10))
+
+    cache = strava.ActivityCache(tmp_path / "cache.db")
+    cache.store([kept, deleted, outside])
+    cache.store([kept], fetched_range=(ts(2024, 3, 1), ts(2024, 4, 1)))
+
+    assert [a["id"] for a in cache.get(ts(2024, 1, 1), ts(2025, 1, 1))] == [1, 3]
+
+    cache.clear()
+    assert cache.get(ts(2024, 1, 1), ts(2025, 1, 1)) == []
+    cache.close()
+
+
+def test_fetch_range_reports_incomplete_at_page_limit(tmp_path):
+    async def main():
+        client = await make_client(EndlessStrava(), cache_path=tmp_path / "cache.db")
+        activities, complete = await client._fetch_range(ts(2024, 1, 1), ts(2025, 1, 1), max_pages=3)
+        await client._sync_range(ts(2024, 1, 1), ts(2025, 1, 1), client._fetch_range)
+        synced = client._cache.synced_until(ts(2024, 1, 1))
+        await client.aclose()
+        return activities, complete, synced
+
+    activities, complete, synced = run(main)
+    assert len(activities) == 300
+    assert not complete
+    assert synced == ts(2024, 1, 1)
+
+
+def test_year_is_served_from_cache_once_synced(tmp_path):
+    api = FakeStrava()
+    for i in range(300):
+        api.add(i, ts(2023, 1, 1) + i * 86400, ["Run", "Ride", "Swim"][i % 3])
+
+    async def main():
+        client = await make_client(api, cache_path=tmp_path / "cache.db")
+        year = await client.get_all_activities_in_year(2023)
+        requests = len(api.requests)
+        runs = await client.get_all_activities_by_date_range("2023-03-01", "2023-03-31", "Run")
+        first = [a async for a in client.iter_activities("2023-03-01", "2023-03-31", "Run")]
+        await client.aclose()
+        return year, runs, first, requests
+
+    year, runs, first, requests = run(main)
+    assert [a["id"] for a in year] == list(range(300))
+    assert len(api.requests) == requests
+    assert runs == first
+    assert all(a["type"] == "Run" for a in runs)
+
+
+def test_activities_without_type_are_skipped_by_filter():
+    api = FakeStrava()
+    api.add(1, ts(2024, 1, 1, 10))
+    api.activities.append({"id": 2, "start_date": datetime.fromtimestamp(ts(2024, 1, 1, 11)).astimezone().isoformat()})
+
+    async def main():
+        client = await make_client(api)
+        activities = await client.get_activities(activity_type="Run")
+        await client.aclose()
+        return activities
+
+    assert [a["id"] for a in run(main)] == [1]
+
+
+def test_prefetch_is_replaced_and_expires():
+    api = FakeStrava()
+    for i in range(150):
+        api.add(i, ts(2024, 1, 1) + i * 3600)
+
+    async def main():
+        client = await make_client(api)
+        await client.get_activities(limit=100)
+        await asyncio.sleep(0)
+        old_task = client._prefetch[(100, None, None, 2, None)][0]
+        await old_task
+
+        # New uploads: a fresh page 1 must replace the page-2 prefetch
+        for i in range(150, 155):
+            api.add(i, ts(2024, 1, 1) + i * 3600)
+        await client.get_activities(limit=100)
+        assert client._prefetch[(100, None, None, 2, None)][0] is not old_task
+        page_2 = await client.get_activities(limit=100, page=2)
+
+        # An expired prefetch is not used
+        client._prefetch_page(100, None, None, 3, None)
+        task, _ = client._prefetch[(100, None, None, 3, None)]
+        await task
+        client._prefetch[(100, None, None, 3, None)] = (task, time.monotonic() - strava.PREFETCH_MAX_AGE - 1)
+        requests = len(api.requests)
+        await client.get_activities(limit=100, page=3)
+        refetched = len(api.requests) > requests
+        await client.aclose()
+        return page_2, refetched
+
+    page_2, refetched = run(main)
+    assert [a["id"] for a in page_2] == list(range(100, 155))
+    assert refetched
+
+
+def test_evicted_prefetch_does_not_cancel_waiters():
+    class SlowStrava(FakeStrava):
+        async def handler(self, request):
+            await asyncio.sleep(0.01)
+            return FakeStrava.handler(self, request)
+
+    api = SlowStrava()
+    for i in range(100):
+        api.add(i, ts(2024, 1, 1) + i * 3600)
+
+    async def main():
+        client = await make_client(api)
+        client._prefetch_page(100, None, None, 1, None)
+        waiter = asyncio.create_task(client._get_activities_page(100, None, None, 1))
+        for page in range(2, 2 + strava.PREFETCH_LIMIT):
+            client._prefetch_page(100, None, None, page, None)
+        activities, count = await waiter
+        await client.aclose()
+        return count
+
+    assert run(main) == 100
+
+
+def test_activity_types_skip_missing_and_null_types():
+    api = FakeStrava()
+    api.add(1, ts(2024, 1, 1, 10))
+    api.add(2, ts(2024, 1, 1, 11), None)
+    api.activities.append({"id": 3, "start_date": datetime.fromtimestamp(ts(2024, 1, 1, 12)).astimezone().isoformat()})
+
+    async def main():
+        client = await make_client(api)
+        first = await client.get_activity_types()
+        api.add(4, ts(2024, 1, 1, 13), "Swim")
+        api.add(5, ts(2024, 1, 1, 14), None)
+        await client.get_activities(limit=10)
+        learned = await client.get_activity_types()
+        await client.aclose()
+        return first, learned
+
+    first, learned = run(main)
+    assert first == ["Run"]
+    assert learned == ["Run", "Swim"]
+
+
+def test_429_is_retried_after_retry_after():
+    class RateLimitedOnce(FakeDetails):
+        def handler(self, request):
+            if not self.requests:
+                self.requests.append(request)
+                return httpx.Response(429, headers={"Retry-After": "0.05"})
+            return FakeDetails.handler(self, request)
+
+    api = RateLimitedOnce()
+
+    async def main():
+        client = await make_client(api)
+        start = time.monotonic()
+        activity = await client.get_activity_by_id(1)
+        elapsed = time.monotonic() - start
+        await client.aclose()
+        return activity, elapsed
+
+    activity, elapsed = run(main)
+    assert activity == {"path": "/api/v3/activities/1"}
+    assert len(api.requests) == 2
+    assert elapsed >= 0.05
+
+
+def test_high_usage_backs_off_for_15_seconds():
+    class NearlyExhausted(FakeDetails):
+        def handler(self, request):
+            response = FakeDetails.handler(self, request)
+            response.headers.update({"X-RateLimit-Usage": "95,500", "X-RateLimit-Limit": "100,1000"})
+            return response
+
+    async def main():
+        client = await make_client(NearlyExhausted())
+        await client.get_activity_by_id(1)
+        remaining = client._rate_limiter._next_ok - time.monotonic()
+        await client.aclose()
+        return remaining
+
+    assert 14 < run(main) <= 15
+
+
+def test_empty_bucket_waits_for_refill():
+    api = FakeDetails()
+
+    async def main():
+        client = await make_client(api)
+        # Two requests per 0.2 s: the third has to wait 0.1 s for a token
+        client._rate_limiter = strava.RateLimiter(max_requests=2, period=0.2)
+        start = time.monotonic()
+        for activity_id in range(3):
+            await client.get_activity_by_id(activity_id)
+        elapsed = time.monotonic() - start
+        await client.aclose()
+        return elapsed
+
+    assert run(main) >= 0.09
+    assert len(api.requests) == 3